@@ -1,16 +1,29 @@
 import os
 import logging
-import sqlite3
+import aiosqlite
+import httpx
 import asyncio
 import time
-from datetime import datetime
+import json
+import io
+import re
+import weakref
+import uuid
+from pathlib import Path
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from openai import AsyncOpenAI, APIConnectionError, RateLimitError, APIError
 
+try:
+    import uvloop
+except ImportError:  # uvloop нет под Windows — остаётся стандартный цикл
+    uvloop = None
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
@@ -19,166 +32,517 @@ logger = logging.getLogger(__name__)
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BASE_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_HEADERS = {
+    "HTTP-Referer": "https://github.com/Purpose-arch/tgbotaimult",
+    "X-Title": "tgbotaimult"
+}
 HISTORY_LIMIT = 10
+EXPORT_LIMIT = 100
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "sqlite")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+HISTORY_CACHE_SIZE = 1024
+CHAT_CACHE_SIZE = 1024
+KEYBOARD_CACHE_SIZE = 1024
+DB_OPTIMIZE_INTERVAL = 60 * 15
+MODELS_CACHE_FILE = "models.json"
+MODELS_CACHE_TTL = 60 * 60 * 24
+MODELS_REFRESH_INTERVAL = 60 * 60 * 6
+MODELS_RETRY_MAX_DELAY = 60 * 5
+EDIT_INTERVAL = 1.0
+EDIT_MIN_CHARS = 64
+# Лимит Telegram — 4096 символов UTF-16; берём с запасом под эмодзи вне BMP
+TELEGRAM_MESSAGE_LIMIT = 4000
+# Повторы после 429 от Telegram: не больше попыток и секунд ожидания суммарно
+TELEGRAM_RETRY_ATTEMPTS = 3
+TELEGRAM_RETRY_BUDGET = 60
+STREAM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "20"))
 
 if not OPENROUTER_API_KEY:
     raise ValueError("OPENROUTER_API_KEY не найден в .env")
 if not BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN не найден в .env")
+if HISTORY_BACKEND not in ("sqlite", "redis"):
+    raise ValueError(f"Неизвестный HISTORY_BACKEND: {HISTORY_BACKEND}")
+
+
+# Запросы горячего пути — константы модуля: текст стабилен, и sqlite3 берёт
+# подготовленные выражения из своего кэша вместо повторного разбора
+_SQL_CREATE_CHAT = 'INSERT INTO chats (user_id, model, created_at, title, history_key) VALUES (?, ?, ?, ?, ?) RETURNING chat_id'
+_SQL_GET_CHATS = 'SELECT chat_id, title, model FROM chats WHERE user_id = ? ORDER BY created_at DESC'
+_SQL_GET_USER_CHAT = 'SELECT model, title, history_key FROM chats WHERE chat_id = ? AND user_id = ? LIMIT 1'
+_SQL_DELETE_CHAT = 'DELETE FROM chats WHERE chat_id = ? AND user_id = ? RETURNING history_key'
+_SQL_RENAME_CHAT = 'UPDATE chats SET title = ? WHERE chat_id = ? AND user_id = ?'
+_SQL_ADD_MESSAGE = 'INSERT INTO history (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)'
+_SQL_GET_HISTORY = '''
+    SELECT role, content FROM (
+        SELECT role, content, message_id FROM history
+        WHERE chat_id = ?
+        ORDER BY message_id DESC
+        LIMIT ?
+    ) ORDER BY message_id ASC
+'''
+_SQL_DELETE_USER_CHATS = 'DELETE FROM chats WHERE user_id = ? RETURNING chat_id, history_key'
+_SQL_GET_FAVORITES = 'SELECT model_id FROM favorites WHERE user_id = ?'
+_SQL_ADD_FAVORITE = 'INSERT OR IGNORE INTO favorites (user_id, model_id) VALUES (?, ?)'
+_SQL_REMOVE_FAVORITE = 'DELETE FROM favorites WHERE user_id = ? AND model_id = ?'
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
 
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('chat_history.db')
-        self._create_tables()
+    def __init__(self, path: str = 'chat_history.db'):
+        self.path = path
+        self.conn = None
+        # Отдельное соединение только для чтения: под WAL читатели не ждут писателя
+        self.read_conn = None
+        # chat_id -> deque последних HISTORY_LIMIT сообщений; SQLite остаётся журналом
+        self._history_cache = LRUCache(HISTORY_CACHE_SIZE)
+        # chat_id -> метка незавершённого заполнения кэша; запись в чат её снимает.
+        # Чтение идёт через другое соединение и может не увидеть ход, закоммиченный
+        # во время SELECT, — такой результат в кэш класть нельзя
+        self._history_fills = {}
+        # chat_id -> (user_id, model, title); метаданные чата почти не меняются
+        self._chat_cache = LRUCache(CHAT_CACHE_SIZE)
+        # Та же защита, что и _history_fills: удаление или переименование во время SELECT
+        # снимает метку, и прочитанная строка в кэш не попадает
+        self._chat_fills = {}
+
+    async def connect(self):
+        self.conn = await aiosqlite.connect(self.path, cached_statements=256)
+        await self._configure_connection()
+        await self._create_tables()
+        # База в памяти существует только внутри своего соединения
+        if self.path == ':memory:':
+            self.read_conn = self.conn
+            return
+        uri = Path(self.path).resolve().as_uri() + '?mode=ro'
+        self.read_conn = await aiosqlite.connect(uri, uri=True, cached_statements=256)
+        await self.read_conn.execute('PRAGMA busy_timeout=5000')
+        await self.read_conn.execute('PRAGMA cache_size=-64000')
+        await self.read_conn.execute('PRAGMA mmap_size=268435456')
+
+    async def close(self):
+        if self.read_conn is not None and self.read_conn is not self.conn:
+            await self.read_conn.close()
+        self.read_conn = None
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    async def _configure_connection(self):
+        await self.conn.execute('PRAGMA foreign_keys=ON')
+        await self.conn.execute('PRAGMA busy_timeout=5000')
+        # WAL и остальные PRAGMA имеют смысл только для файловой базы
+        if self.path == ':memory:':
+            return
+        async with self.conn.execute('PRAGMA journal_mode=WAL') as cursor:
+            journal_mode = (await cursor.fetchone())[0]
+        if journal_mode.lower() != 'wal':
+            logger.warning(f"Не удалось включить WAL, режим журнала: {journal_mode}")
+        await self.conn.execute('PRAGMA synchronous=NORMAL')
+        await self.conn.execute('PRAGMA temp_store=MEMORY')
+        await self.conn.execute('PRAGMA cache_size=-64000')
+        await self.conn.execute('PRAGMA mmap_size=268435456')
+
+    async def optimize(self):
+        await self.conn.execute('PRAGMA optimize')
 
-    def _create_tables(self):
-        cursor = self.conn.cursor()
-        cursor.execute('''
+    async def _create_tables(self):
+        # sqlite3 не открывает транзакцию для DDL сам — иначе каждый CREATE коммитится отдельно
+        await self.conn.execute('BEGIN')
+        await self.conn.execute('''
             CREATE TABLE IF NOT EXISTS chats (
                 chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
                 model TEXT,
-                created_at DATETIME,
-                title TEXT
+                created_at INTEGER,
+                title TEXT,
+                history_key TEXT
             )
         ''')
-        cursor.execute('''
+        # Глобально уникальный ключ истории для внешнего хранилища: chat_id локален для
+        # этого файла и повторяется, если базу создать заново
+        async with self.conn.execute('PRAGMA table_info(chats)') as cursor:
+            chat_columns = {row[1] async for row in cursor}
+        if 'history_key' not in chat_columns:
+            await self.conn.execute('ALTER TABLE chats ADD COLUMN history_key TEXT')
+            await self.conn.execute('UPDATE chats SET history_key = lower(hex(randomblob(16)))')
+        # Старые базы создавались без внешнего ключа — пересобираем history
+        async with self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'"
+        ) as cursor:
+            history_exists = await cursor.fetchone() is not None
+        async with self.conn.execute('PRAGMA foreign_key_list(history)') as cursor:
+            history_has_fk = await cursor.fetchone() is not None
+        migrate_history = history_exists and not history_has_fk
+        if migrate_history:
+            await self.conn.execute('ALTER TABLE history RENAME TO history_legacy')
+        await self.conn.execute('''
             CREATE TABLE IF NOT EXISTS history (
                 message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
+                chat_id INTEGER REFERENCES chats(chat_id) ON DELETE CASCADE,
                 role TEXT,
                 content TEXT,
-                timestamp DATETIME
+                timestamp INTEGER
             )
         ''')
+        if migrate_history:
+            await self.conn.execute('''
+                INSERT INTO history (message_id, chat_id, role, content, timestamp)
+                SELECT message_id, chat_id, role, content, timestamp FROM history_legacy
+                WHERE chat_id IN (SELECT chat_id FROM chats)
+            ''')
+            await self.conn.execute('DROP TABLE history_legacy')
+        async with self.conn.execute('PRAGMA user_version') as cursor:
+            (schema_version,) = await cursor.fetchone()
+        if schema_version < 1:
+            # Время хранится целым числом миллисекунд; старые ISO-строки переводим один раз
+            await self.conn.execute('''
+                UPDATE chats SET created_at = CAST(ROUND((julianday(created_at) - 2440587.5) * 86400000) AS INTEGER)
+                WHERE typeof(created_at) = 'text'
+            ''')
+            await self.conn.execute('''
+                UPDATE history SET timestamp = CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER)
+                WHERE typeof(timestamp) = 'text'
+            ''')
+            await self.conn.execute('PRAGMA user_version = 1')
+        # Записи индекса по chat_id упорядочены по rowid (message_id) — окно истории
+        # читается без сортировки
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_history_chat ON history(chat_id)')
+        await self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chats_user_created
+            ON chats(user_id, created_at DESC)
+        ''')
         
-        cursor.execute('''
+        await self.conn.execute('''
             CREATE TABLE IF NOT EXISTS favorites (
                 user_id INTEGER,
                 model_id TEXT,
                 PRIMARY KEY (user_id, model_id)
             )
         ''')
-        self.conn.commit()
-
-    def create_chat(self, user_id: int, model: str, title: str):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO chats (user_id, model, created_at, title)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, model, datetime.now(), title))
-        self.conn.commit()
-        return cursor.lastrowid
-
-    def get_chats(self, user_id: int):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT chat_id, title, model FROM chats 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        return cursor.fetchall()
-
-    def delete_chat(self, chat_id: int):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM history WHERE chat_id = ?', (chat_id,))
-        self.conn.commit()
-
-    def rename_chat(self, chat_id: int, new_title: str):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE chats SET title = ? 
-            WHERE chat_id = ?
-        ''', (new_title, chat_id))
-        self.conn.commit()
-
-    def add_message(self, chat_id: int, role: str, content: str):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO history (chat_id, role, content, timestamp)
-            VALUES (?, ?, ?, ?)
-        ''', (chat_id, role, content, datetime.now()))
-        self.conn.commit()
-
-    def get_history(self, chat_id: int, limit: int = HISTORY_LIMIT):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT role, content FROM history 
-            WHERE chat_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (chat_id, limit))
-        result = cursor.fetchall()
-        return [{"role": role, "content": content} for role, content in reversed(result)]
+        await self.conn.commit()
+        # Статистика для планировщика собирается один раз; дальше её обновляет PRAGMA optimize
+        async with self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ) as cursor:
+            has_stats = await cursor.fetchone() is not None
+        if not has_stats:
+            await self.conn.execute('ANALYZE')
+            await self.conn.commit()
+        else:
+            await self.optimize()
+
+    async def create_chat(self, user_id: int, model: str, title: str):
+        history_key = uuid.uuid4().hex
+        async with self.conn.execute(_SQL_CREATE_CHAT, (user_id, model, now_ms(), title, history_key)) as cursor:
+            (chat_id,) = await cursor.fetchone()
+        await self.conn.commit()
+        self._chat_cache.put(chat_id, (user_id, model, title, history_key))
+        return chat_id
+
+    async def get_chats(self, user_id: int):
+        async with self.read_conn.execute(_SQL_GET_CHATS, (user_id,)) as cursor:
+            return await cursor.fetchall()
+
+    async def get_chat_for_user(self, chat_id: int, user_id: int):
+        # Возвращает (model, title, history_key) только если чат принадлежит пользователю
+        chat = self._chat_cache.get(chat_id)
+        if chat is None:
+            fill = self._chat_fills[chat_id] = object()
+            try:
+                async with self.read_conn.execute(_SQL_GET_USER_CHAT, (chat_id, user_id)) as cursor:
+                    row = await cursor.fetchone()
+            finally:
+                fresh = self._chat_fills.get(chat_id) is fill
+                if fresh:
+                    del self._chat_fills[chat_id]
+            if row is None:
+                return None
+            chat = (user_id, *row)
+            if fresh:
+                self._chat_cache.put(chat_id, chat)
+        if chat[0] != user_id:
+            return None
+        return chat[1:]
+
+    async def delete_chat(self, chat_id: int, user_id: int):
+        # История удаляется каскадно по внешнему ключу; возвращает history_key или None
+        async with self.conn.execute(_SQL_DELETE_CHAT, (chat_id, user_id)) as cursor:
+            row = await cursor.fetchone()
+        await self.conn.commit()
+        if row is None:
+            return None
+        self._history_cache.pop(chat_id)
+        self._history_fills.pop(chat_id, None)
+        self._chat_cache.pop(chat_id)
+        self._chat_fills.pop(chat_id, None)
+        return row[0]
+
+    async def rename_chat(self, chat_id: int, user_id: int, new_title: str):
+        cursor = await self.conn.execute(_SQL_RENAME_CHAT, (new_title, chat_id, user_id))
+        await self.conn.commit()
+        if not cursor.rowcount:
+            return False
+        self._chat_fills.pop(chat_id, None)
+        chat = self._chat_cache.get(chat_id)
+        if chat is not None:
+            self._chat_cache.put(chat_id, (chat[0], chat[1], new_title, chat[3]))
+        return True
+
+    async def add_message(self, chat_id: int, role: str, content: str):
+        await self.add_messages(chat_id, [(role, content)])
+
+    async def add_messages(self, chat_id: int, rows: list):
+        # Все сообщения хода пишутся в одной транзакции — один commit на ход
+        now = now_ms()
+        await self.conn.executemany(
+            _SQL_ADD_MESSAGE, [(chat_id, role, content, now) for role, content in rows]
+        )
+        await self.conn.commit()
+        self._cache_messages(chat_id, *({"role": role, "content": content} for role, content in rows))
+
+    def _cache_messages(self, chat_id: int, *messages):
+        self._history_fills.pop(chat_id, None)
+        # Дописываем только в уже прогретый кэш: иначе в нём не будет полной истории
+        cached = self._history_cache.get(chat_id)
+        if cached is not None:
+            cached.extend(messages)
+
+    async def get_history(self, chat_id: int, limit: int = HISTORY_LIMIT):
+        if limit <= HISTORY_LIMIT:
+            cached = self._history_cache.get(chat_id)
+            if cached is not None:
+                return list(cached)[-limit:]
+        fill = self._history_fills[chat_id] = object()
+        try:
+            async with self.read_conn.execute(_SQL_GET_HISTORY, (chat_id, limit)) as cursor:
+                history = [{"role": role, "content": content} async for role, content in cursor]
+        finally:
+            fresh = self._history_fills.get(chat_id) is fill
+            if fresh:
+                del self._history_fills[chat_id]
+        if fresh and limit >= HISTORY_LIMIT:
+            self._history_cache.put(chat_id, deque(history[-HISTORY_LIMIT:], maxlen=HISTORY_LIMIT))
+        return history
 
     
-    def delete_all_chats(self, user_id: int):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            DELETE FROM history WHERE chat_id IN (
-                SELECT chat_id FROM chats WHERE user_id = ?
-            )
-        ''', (user_id,))
-        cursor.execute('DELETE FROM chats WHERE user_id = ?', (user_id,))
-        self.conn.commit()
+    async def delete_all_chats(self, user_id: int):
+        # История удаляется каскадно; RETURNING отдаёт id чатов для очистки кэшей
+        # и ключи истории для внешнего хранилища
+        async with self.conn.execute(_SQL_DELETE_USER_CHATS, (user_id,)) as cursor:
+            rows = await cursor.fetchall()
+        await self.conn.commit()
+        for chat_id, _ in rows:
+            self._history_cache.pop(chat_id)
+            self._history_fills.pop(chat_id, None)
+            self._chat_cache.pop(chat_id)
+            self._chat_fills.pop(chat_id, None)
+        return [history_key for _, history_key in rows]
 
    
-    def get_favorites(self, user_id: int):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT model_id FROM favorites WHERE user_id = ?', (user_id,))
-        rows = cursor.fetchall()
-        return [row[0] for row in rows]
-
-    def add_favorite(self, user_id: int, model_id: str):
-        cursor = self.conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO favorites (user_id, model_id) VALUES (?, ?)', (user_id, model_id))
-        self.conn.commit()
-
-    def remove_favorite(self, user_id: int, model_id: str):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM favorites WHERE user_id = ? AND model_id = ?', (user_id, model_id))
-        self.conn.commit()
+    async def get_favorites(self, user_id: int):
+        async with self.read_conn.execute(_SQL_GET_FAVORITES, (user_id,)) as cursor:
+            return {row[0] async for row in cursor}
+
+    async def add_favorite(self, user_id: int, model_id: str):
+        await self.conn.execute(_SQL_ADD_FAVORITE, (user_id, model_id))
+        await self.conn.commit()
+
+    async def remove_favorite(self, user_id: int, model_id: str):
+        await self.conn.execute(_SQL_REMOVE_FAVORITE, (user_id, model_id))
+        await self.conn.commit()
+
+# История в Redis (HISTORY_BACKEND=redis): список последних EXPORT_LIMIT сообщений на чат.
+# Ключ строится из history_key чата (UUID), а не из chat_id: chat_id выдаёт локальный
+# SQLite, и после пересоздания базы он указал бы на чужую историю. Чаты, их владельцы
+# и избранное остаются в SQLite, поэтому файл базы должен переживать перезапуск.
+class RedisHistory:
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError as e:
+            raise ValueError("Для HISTORY_BACKEND=redis установите пакет redis") from e
+        self.redis = aioredis.from_url(url, decode_responses=True)
+
+    async def close(self):
+        await self.redis.close()
+
+    @staticmethod
+    def _key(history_key: str):
+        return f"chat:{history_key}:history"
+
+    async def _push(self, history_key: str, *messages):
+        key = self._key(history_key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lpush(key, *(json.dumps(m, ensure_ascii=False) for m in messages))
+            pipe.ltrim(key, 0, EXPORT_LIMIT - 1)
+            await pipe.execute()
+
+    async def add_message(self, history_key: str, role: str, content: str):
+        await self._push(history_key, {"role": role, "content": content})
+
+    async def add_messages(self, history_key: str, rows: list):
+        await self._push(history_key, *({"role": role, "content": content} for role, content in rows))
+
+    async def get_history(self, history_key: str, limit: int = HISTORY_LIMIT):
+        # LPUSH кладёт новые сообщения в голову списка — разворачиваем в хронологию
+        items = await self.redis.lrange(self._key(history_key), 0, limit - 1)
+        return [json.loads(item) for item in reversed(items)]
+
+    async def delete_history(self, *history_keys: str):
+        if history_keys:
+            await self.redis.delete(*(self._key(history_key) for history_key in history_keys))
 
 db = Database()
+history_store = RedisHistory(REDIS_URL) if HISTORY_BACKEND == "redis" else db
+
+def history_id(chat_id: int, history_key: str):
+    # SQLite хранит историю по chat_id, внешнее хранилище — по history_key
+    return chat_id if history_store is db else history_key
+
+async def delete_chat_history(*history_keys: str):
+    # Из SQLite история удаляется вместе с чатом; внешнее хранилище чистим отдельно
+    if history_store is not db:
+        await history_store.delete_history(*history_keys)
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+# Один пул соединений на все запросы: TCP/TLS-рукопожатие только на первом вызове
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60.0),
+    timeout=httpx.Timeout(connect=5.0, read=120.0, write=10.0, pool=5.0),
+)
+
 client = AsyncOpenAI(
     base_url=BASE_URL,
     api_key=OPENROUTER_API_KEY,
+    http_client=http_client,
+    max_retries=3,
 )
 
 
 MODELS = {}
+# Подпись кнопки (display) -> model_key
+MODEL_BY_LABEL = {}
+# folder -> [(model_key, model_data)], отсортировано по имени; пересчитывается вместе с MODELS
+MODEL_FOLDERS = {}
+# Растёт при каждой пересборке MODELS — клавиатуры старых версий считаются устаревшими
+_MODELS_VERSION = 0
+# (вид клавиатуры, user_id) -> (_MODELS_VERSION, markup)
+_keyboard_cache = LRUCache(KEYBOARD_CACHE_SIZE)
 
 async def get_available_models():
-    try:
-        response = await client.models.list()
-        return [model.id for model in response.data if model.id.endswith(":free")]
-    except Exception as e:
-        logger.error(f"Ошибка при получении списка моделей: {e}")
-        return []
+    response = await client.models.list()
+    return [model.id for model in response.data if model.id.endswith(":free")]
 
-async def update_models():
-    global MODELS
-    available_models = await get_available_models()
-    
-    MULTIMODAL_INDICATORS = ["gpt-4", "multimodal", "vision"]
-    MODELS = {}
+_MM_RE = re.compile(r"gpt-4|multimodal|vision", re.I)
+
+def set_models(available_models):
+    global MODELS, MODEL_BY_LABEL, MODEL_FOLDERS, _MODELS_VERSION
+    models = {}
+    model_by_label = {}
     for model in available_models:
         short_name = model.split('/')[-1].replace(':free', '')
-        is_multimodal = any(ind in short_name.lower() for ind in MULTIMODAL_INDICATORS)
-        MODELS[model] = {"name": short_name, "multimodal": is_multimodal}
+        is_multimodal = bool(_MM_RE.search(short_name))
+        # Подпись кнопки считается один раз, а не при каждой сборке клавиатуры
+        display = f"{short_name} 🖼️" if is_multimodal else short_name
+        models[model] = {"name": short_name, "multimodal": is_multimodal, "display": display}
+        # При совпадении коротких имён выигрывает первая модель, как и раньше
+        model_by_label.setdefault(display, model)
+    model_folders = {}
+    for model_key, model_data in models.items():
+        folder = model_data["name"].split('-')[0]
+        model_folders.setdefault(folder, []).append((model_key, model_data))
+    for folder_models in model_folders.values():
+        folder_models.sort(key=lambda x: x[1]["name"])
+    MODELS, MODEL_BY_LABEL, MODEL_FOLDERS = models, model_by_label, model_folders
+    _MODELS_VERSION += 1
+
+def load_cached_models():
+    # Возвращает возраст кэша в секундах или None, если кэша нет
+    try:
+        age = time.time() - os.path.getmtime(MODELS_CACHE_FILE)
+        with open(MODELS_CACHE_FILE, encoding='utf-8') as f:
+            cached_models = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Кэш списка моделей недоступен: {e}")
+        return None
+    # Файл мог остаться от другой версии формата — такой кэш считаем отсутствующим
+    if not (isinstance(cached_models, list) and cached_models
+            and all(isinstance(model, str) for model in cached_models)):
+        logger.warning("Кэш списка моделей имеет неверный формат")
+        return None
+    set_models(cached_models)
+    return age
+
+def save_cached_models(available_models):
+    tmp_path = MODELS_CACHE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(available_models, f)
+    os.replace(tmp_path, MODELS_CACHE_FILE)
 
-async def model_updater():
+async def update_models():
+    # При ошибке OpenRouter остаётся прежний список моделей, а не пустой
+    try:
+        available_models = await get_available_models()
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка моделей: {e}")
+        return False
+    if not available_models:
+        logger.warning("OpenRouter вернул пустой список моделей")
+        return False
+    set_models(available_models)
+    try:
+        save_cached_models(available_models)
+    except OSError as e:
+        logger.error(f"Ошибка при сохранении кэша моделей: {e}")
+    return True
+
+async def model_updater(initial_delay: float = 0):
+    await asyncio.sleep(initial_delay)
+    attempt = 0
     while True:
-        await update_models()
-        await asyncio.sleep(60 * 5)  # Update every 5 minutes
+        if await update_models():
+            attempt = 0
+            delay = MODELS_REFRESH_INTERVAL
+        else:
+            delay = min(MODELS_RETRY_MAX_DELAY, 2 ** attempt)
+            attempt = min(attempt + 1, 16)
+        await asyncio.sleep(delay)
 
-asyncio.run(update_models())
+async def db_optimizer():
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL)
+        try:
+            await db.optimize()
+        except aiosqlite.Error as e:
+            logger.error(f"Ошибка при оптимизации базы данных: {e}")
 
 class ChatStates(StatesGroup):
     choosing_model = State()
@@ -187,7 +551,9 @@ class ChatStates(StatesGroup):
     waiting_for_message = State()
 
 
-def main_menu_keyboard():
+REMOVE_KEYBOARD = types.ReplyKeyboardRemove()
+
+def _build_main_menu():
     builder = ReplyKeyboardBuilder()
     builder.add(types.KeyboardButton(text="➕ Новый чат"))
     builder.add(types.KeyboardButton(text="📂 Мои чаты"))
@@ -197,75 +563,92 @@ def main_menu_keyboard():
     builder.adjust(2, 2, 1)
     return builder.as_markup(resize_keyboard=True)
 
-def model_selection_keyboard(user_id: int):
+MAIN_MENU_MARKUP = _build_main_menu()
+
+def model_display(model_key: str):
+    # Модель могла пропасть из списка OpenRouter — тогда показываем её id
+    model_info = MODELS.get(model_key)
+    return model_info["display"] if model_info else model_key
+
+def cached_keyboard(kind: str, user_id: int):
+    entry = _keyboard_cache.get((kind, user_id))
+    if entry is not None and entry[0] == _MODELS_VERSION:
+        return entry[1]
+    return None
+
+def cache_keyboard(kind: str, user_id: int, markup):
+    _keyboard_cache.put((kind, user_id), (_MODELS_VERSION, markup))
+    return markup
+
+def invalidate_user_keyboards(user_id: int):
+    # Клавиатуры зависят от избранного — сбрасываем их при каждом его изменении
+    _keyboard_cache.pop(("models", user_id))
+    _keyboard_cache.pop(("favorites", user_id))
+
+async def model_selection_keyboard(user_id: int):
+    markup = cached_keyboard("models", user_id)
+    if markup is not None:
+        return markup
     builder = ReplyKeyboardBuilder()
-    favorites = db.get_favorites(user_id)
-    favorite_models = []
-    other_models = {}
-    
-    for model_key, model_data in MODELS.items():
-        if model_key in favorites:
-            favorite_models.append((model_key, model_data))
-        else:
-            folder = model_data["name"].split('-')[0] 
-            if folder not in other_models:
-                other_models[folder] = []
-            other_models[folder].append((model_key, model_data))
-    
-    favorite_models.sort(key=lambda x: x[1]["name"])
-    for folder in other_models:
-        other_models[folder].sort(key=lambda x: x[1]["name"])
+    favorites = await db.get_favorites(user_id)
+    favorite_models = sorted(
+        ((model_key, MODELS[model_key]) for model_key in favorites if model_key in MODELS),
+        key=lambda x: x[1]["name"]
+    )
     
     if favorite_models:
         builder.add(types.KeyboardButton(text="⭐ Избранное"))
         for model_key, model_data in favorite_models:
-            display = model_data["name"]
-            if model_data["multimodal"]:
-                display += " 🖼️"
-            builder.add(types.KeyboardButton(text=display))
+            builder.add(types.KeyboardButton(text=model_data["display"]))
     
-    for folder, models in other_models.items():
+    for folder, folder_models in MODEL_FOLDERS.items():
+        models = [(k, d) for k, d in folder_models if k not in favorites]
+        if not models:
+            continue
         builder.add(types.KeyboardButton(text=f"📁 {folder}"))
         for model_key, model_data in models:
-            display = model_data["name"]
-            if model_data["multimodal"]:
-                display += " 🖼️"
-            builder.add(types.KeyboardButton(text=display))
+            builder.add(types.KeyboardButton(text=model_data["display"]))
     
     builder.add(types.KeyboardButton(text="↩️ Назад"))
     builder.adjust(1)
-    return builder.as_markup(resize_keyboard=True)
+    return cache_keyboard("models", user_id, builder.as_markup(resize_keyboard=True))
 
 
-def settings_menu_keyboard():
+def _build_settings_menu():
     builder = InlineKeyboardBuilder()
     builder.row(types.InlineKeyboardButton(text="Избранные модели", callback_data="settings_favorites"))
     builder.row(types.InlineKeyboardButton(text="↩️ Назад", callback_data="settings_back"))
     return builder.as_markup()
 
-def favorite_models_keyboard(user_id: int):
+SETTINGS_MENU_MARKUP = _build_settings_menu()
+
+async def favorite_models_keyboard(user_id: int, favorites: set = None):
+    markup = cached_keyboard("favorites", user_id)
+    if markup is not None:
+        return markup
     builder = InlineKeyboardBuilder()
-    favorites = db.get_favorites(user_id)
+    if favorites is None:
+        favorites = await db.get_favorites(user_id)
     for model_key, model_data in MODELS.items():
         is_fav = model_key in favorites
         text = f"{model_data['name']} {'✅' if is_fav else '❌'}"
         builder.row(types.InlineKeyboardButton(text=text, callback_data=f"toggle_fav_{model_key}"))
     builder.row(types.InlineKeyboardButton(text="↩️ Назад", callback_data="settings_back"))
-    return builder.as_markup()
+    return cache_keyboard("favorites", user_id, builder.as_markup())
 
 @dp.message(F.text == "/start")
 async def cmd_start(message: types.Message, state: FSMContext):
     await message.answer("🤖 Добро пожаловать в нейро-чат!")
     await message.answer(
         "👇 Выберите действие:",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_MARKUP
     )
 
 @dp.message(F.text == "/menu")
 async def cmd_menu(message: types.Message, state: FSMContext):
     await message.answer(
         "📝 Главное меню:",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_MARKUP
     )
 
 @dp.message(F.text == "➕ Новый чат")
@@ -276,28 +659,23 @@ async def create_new_chat(message: types.Message, state: FSMContext):
     await state.set_state(ChatStates.choosing_model)
     await message.answer(
         "🤖 Выберите модель для нового чата:",
-        reply_markup=model_selection_keyboard(message.from_user.id)
+        reply_markup=await model_selection_keyboard(message.from_user.id)
     )
 
 @dp.message(ChatStates.choosing_model)
 async def model_selected(message: types.Message, state: FSMContext):
     if message.text == "↩️ Назад":
         await state.clear()
-        await message.answer("↩️ Отмена создания нового чата", reply_markup=main_menu_keyboard())
+        await message.answer("↩️ Отмена создания нового чата", reply_markup=MAIN_MENU_MARKUP)
         return
 
-    selected_text = message.text.replace(" 🖼️", "")
-    selected_model_key = None
-    for model_key, model_data in MODELS.items():
-        if model_data["name"] == selected_text:
-            selected_model_key = model_key
-            break
+    selected_model_key = MODEL_BY_LABEL.get(message.text)
     if selected_model_key:
         await state.update_data(selected_model=selected_model_key)
         await state.set_state(ChatStates.naming_chat)
         await message.answer(
             "📝 Введите название для нового чата:",
-            reply_markup=types.ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
     else:
         await message.answer("❌ Выбранная модель недоступна. Пожалуйста, выберите другую.")
@@ -308,18 +686,18 @@ async def chat_named(message: types.Message, state: FSMContext):
     model_key = data['selected_model']
     title = message.text[:30]
     
-    chat_id = db.create_chat(message.from_user.id, model_key, title)
-    await state.update_data(current_chat=chat_id)
+    chat_id = await db.create_chat(message.from_user.id, model_key, title)
+    await state.update_data(current_chat=chat_id, current_title=title, current_model=model_key)
     await state.set_state(ChatStates.waiting_for_message)
     await message.answer(
         f"✅ Чат '{title}' создан!\nТеперь вы можете начать общение!",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_MARKUP
     )
 
 @dp.message(F.text == "📂 Мои чаты")
 async def show_chats(message: types.Message):
     user_id = message.from_user.id
-    chats = db.get_chats(user_id)
+    chats = await db.get_chats(user_id)
     
     if not chats:
         await message.answer("📭 У вас пока нет сохраненных чатов")
@@ -327,15 +705,8 @@ async def show_chats(message: types.Message):
     
     builder = InlineKeyboardBuilder()
     for chat in chats:
-        model_info = MODELS.get(chat[2])
-        if model_info:
-            model_display = model_info["name"]
-            if model_info["multimodal"]:
-                model_display += " 🖼️"
-        else:
-            model_display = chat[2]
         builder.row(types.InlineKeyboardButton(
-            text=f"{chat[1]} ({model_display})",
+            text=f"{chat[1]} ({model_display(chat[2])})",
             callback_data=f"chat_{chat[0]}"
             )
         )
@@ -361,29 +732,31 @@ async def refresh_chats(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("chat_"))
 async def select_chat(callback: types.CallbackQuery, state: FSMContext):
     chat_id = int(callback.data.split("_")[1])
-    await state.update_data(current_chat=chat_id)
+    chat_info = await db.get_chat_for_user(chat_id, callback.from_user.id)
+    if not chat_info:
+        await callback.answer("❌ Чат не найден")
+        return
+    model_key, title, _ = chat_info
+    await state.update_data(current_chat=chat_id, current_title=title, current_model=model_key)
     await state.set_state(ChatStates.waiting_for_message)  # Устанавливаем нужное состояние
     await callback.message.answer(
         "✅ Переключено на выбранный чат",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_MARKUP
     )
     await callback.answer()
+    # Прогреваем кэш истории, пока пользователь набирает первое сообщение
+    if history_store is db:
+        await db.get_history(chat_id)
 
 
 @dp.message(F.text == "📊 Текущий чат")
 async def show_current_chat(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    chat_id = data.get('current_chat')
-    if chat_id:
-        chats = db.get_chats(message.from_user.id)
-        chat_info = next((c for c in chats if c[0] == chat_id), None)
-        if chat_info:
-            model_info = MODELS.get(chat_info[2])
-            model_display = model_info["name"] if model_info else chat_info[2]
-            if model_info and model_info["multimodal"]:
-                model_display += " 🖼️"
-            await message.answer(f"🔮 Активный чат: {chat_info[1]}\nМодель: {model_display}")
-            return
+    if data.get('current_chat'):
+        await message.answer(
+            f"🔮 Активный чат: {data['current_title']}\nМодель: {model_display(data['current_model'])}"
+        )
+        return
     await message.answer("❌ Нет активного чата")
 
 @dp.message(F.text == "📤 Экспорт истории")
@@ -395,12 +768,21 @@ async def export_history(message: types.Message, state: FSMContext):
         await message.answer("❌ Нет активного чата")
         return
     
-    history = db.get_history(chat_id, limit=100)
-    formatted = "\n\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
+    chat_info = await db.get_chat_for_user(chat_id, message.from_user.id)
+    if not chat_info:
+        await message.answer("❌ Чат не найден")
+        return
+    history = await history_store.get_history(history_id(chat_id, chat_info[2]), limit=EXPORT_LIMIT)
+    # Пишем по сообщению сразу в байты, без промежуточного списка и общей строки
+    buf = io.BytesIO()
+    for i, msg in enumerate(history):
+        if i:
+            buf.write(b"\n\n")
+        buf.write(f"{msg['role']}: {msg['content']}".encode('utf-8'))
     
     await message.answer_document(
         types.BufferedInputFile(
-            formatted.encode('utf-8'), 
+            buf.getvalue(), 
             filename=f"chat_history_{chat_id}.txt"
         ),
         caption="📝 История вашего чата"
@@ -410,100 +792,231 @@ async def export_history(message: types.Message, state: FSMContext):
 async def settings_menu(message: types.Message):
     await message.answer(
         "⚙️ Настройки:",
-        reply_markup=settings_menu_keyboard()
+        reply_markup=SETTINGS_MENU_MARKUP
     )
 
-@dp.message(F.text)
+# Не больше STREAM_CONCURRENCY одновременных стримов на бота и один на пользователя
+STREAM_SEMAPHORE = asyncio.Semaphore(STREAM_CONCURRENCY)
+_user_stream_locks = weakref.WeakValueDictionary()
+
+def user_stream_lock(user_id: int):
+    lock = _user_stream_locks.get(user_id)
+    if lock is None:
+        lock = _user_stream_locks[user_id] = asyncio.Lock()
+    return lock
+
+async def retry_after_limit(request):
+    # Повторяет запрос к Telegram после 429, но ограниченно: вызывающий держит слот
+    # STREAM_SEMAPHORE и блокировку пользователя. Возвращает None, если сдались
+    waited = 0
+    for attempt in range(TELEGRAM_RETRY_ATTEMPTS):
+        try:
+            return await request()
+        except TelegramRetryAfter as e:
+            if attempt == TELEGRAM_RETRY_ATTEMPTS - 1 or waited + e.retry_after > TELEGRAM_RETRY_BUDGET:
+                logger.error(f"Telegram ограничил частоту запросов, отправка отменена: {e}")
+                return None
+            waited += e.retry_after
+            await asyncio.sleep(e.retry_after)
+
+async def stream_reply(stream, sent_message: types.Message):
+    # Чтение стрима и правки сообщения идут параллельно: HTTP-запрос в Telegram
+    # не задерживает чтение следующего чанка от модели
+    parts = []
+    answer_len = 0
+    updated = asyncio.Event()
+    finished = asyncio.Event()
+
+    async def producer():
+        nonlocal answer_len
+        try:
+            async for chunk in stream:
+                delta_content = chunk.choices[0].delta.content
+                if delta_content:
+                    parts.append(delta_content)
+                    answer_len += len(delta_content)
+                    updated.set()
+        finally:
+            finished.set()
+            updated.set()
+
+    async def consumer():
+        last_edit_len = 0
+        last_sent = ""
+        while not finished.is_set():
+            await updated.wait()
+            updated.clear()
+            # Чем длиннее ответ, тем реже правим: каждая правка пересылает весь текст
+            min_chars = max(EDIT_MIN_CHARS, answer_len // 10)
+            if finished.is_set() or answer_len - last_edit_len < min_chars:
+                continue
+            # Пока идёт стрим, показываем только то, что влезет в первое сообщение
+            edit_len = answer_len
+            text = "".join(parts)[:TELEGRAM_MESSAGE_LIMIT - 1]
+            # Прирост из одних пробелов Telegram отклонит как "message is not modified"
+            if text.rstrip() == last_sent:
+                continue
+            pause = EDIT_INTERVAL
+            try:
+                await sent_message.edit_text(text + "●")
+                last_edit_len = edit_len
+                last_sent = text.rstrip()
+            except TelegramRetryAfter as e:
+                pause = e.retry_after
+            except TelegramBadRequest:
+                pass
+            except Exception:
+                logger.exception("Ошибка при обновлении сообщения")
+            try:
+                await asyncio.wait_for(finished.wait(), timeout=pause)
+            except asyncio.TimeoutError:
+                pass
+
+    await asyncio.gather(producer(), consumer())
+    text = "".join(parts)
+    if not text.strip():
+        text = ""
+    # Финальная правка обязательна: иначе в чате останется ответ с маркером "●"
+    chunks = [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)]
+    try:
+        await retry_after_limit(lambda: sent_message.edit_text(chunks[0] if chunks else "⚠️ Модель вернула пустой ответ"))
+    except TelegramBadRequest as e:
+        if "message is not modified" not in e.message:
+            logger.error(f"Ошибка при финальной правке сообщения: {e}")
+    # Длинный ответ досылаем отдельными сообщениями
+    for chunk in chunks[1:]:
+        if await retry_after_limit(lambda: sent_message.answer(chunk)) is None:
+            break
+    return text
+
+# Регистрируется после кнопок меню: их точные текстовые фильтры должны срабатывать первыми
+@dp.message(ChatStates.waiting_for_message, F.text)
 async def handle_message(message: types.Message, state: FSMContext):
-    current_state = await state.get_state()
-    if current_state != ChatStates.waiting_for_message:
-        return
+    await answer_message(message, state, message.text)
+
+@dp.message(ChatStates.waiting_for_message, F.photo | F.document)
+async def handle_attachment(message: types.Message, state: FSMContext):
+    # Сами файлы модели не передаются — только подпись и отметка о вложении
+    lines = [message.caption] if message.caption else []
+    lines.append("[Прикреплено фото]" if message.photo else "[Прикреплен документ]")
+    await answer_message(message, state, "\n".join(lines))
+
+async def answer_message(message: types.Message, state: FSMContext, content: str):
     data = await state.get_data()
     chat_id = data.get('current_chat')
     
     if not chat_id:
         await message.answer("❌ Сначала выберите или создайте чат!")
         return
-    
-    content = message.text
-    if message.photo:
-        content += "\n[Прикреплено фото]"
-    if message.document:
-        content += "\n[Прикреплен документ]"
         
-    db.add_message(chat_id, "user", content)
-    
+    model_key = None
+    turn_saved = False
+    placeholder_message = None
+
+    async def report_error(text: str):
+        # Если стрим не открылся, заглушку "●" превращаем в сообщение об ошибке
+        if placeholder_message is not None:
+            try:
+                await placeholder_message.edit_text(text)
+                return
+            except TelegramBadRequest:
+                pass
+        await message.answer(text)
+
     try:
-        chats = db.get_chats(message.from_user.id)
-        chat_info = next((c for c in chats if c[0] == chat_id), None)
+        chat_info = await db.get_chat_for_user(chat_id, message.from_user.id)
         if not chat_info:
             await message.answer("❌ Чат не найден")
             return
             
-        model_key = chat_info[2]
+        model_key, _, history_key = chat_info
+        chat_history_id = history_id(chat_id, history_key)
 
-        history = db.get_history(chat_id)
-        
-        sent_message = await message.answer("●")
-        full_answer = ""
-        last_edit_time = time.monotonic()
-        edit_interval = 1.5
-        
-        stream = await client.chat.completions.create(
-            model=model_key,
-            messages=history + [{"role": "user", "content": content}],
-            stream=True,
-            extra_headers={
-                "HTTP-Referer": "https://github.com/Purpose-arch/tgbotaimult",
-                "X-Title": "tgbotaimult"
-            }
-        )
-        
-        async for chunk in stream:
-            if chunk.choices[0].delta.content:
-                delta_content = chunk.choices[0].delta.content
-                full_answer += delta_content
-                now = time.monotonic()
-                if now - last_edit_time >= edit_interval or len(delta_content) < 3:
-                    try:
-                        await sent_message.edit_text(full_answer + "●")
-                        last_edit_time = now
-                    except Exception as e:
-                        logger.error(f"Ошибка при обновлении сообщения: {e}")
-        
-        await sent_message.edit_text(full_answer)
-        db.add_message(chat_id, "assistant", full_answer)
+        # Запросы одного пользователя идут по очереди, чтобы следующий видел историю предыдущего
+        async with user_stream_lock(message.from_user.id):
+            history = await history_store.get_history(chat_history_id)
+            messages = history + [{"role": "user", "content": content}]
+
+            queued_message = None
+            if STREAM_SEMAPHORE.locked():
+                queued_message = await message.answer("⏳ Запрос в очереди, ответ скоро начнётся…")
+            async with STREAM_SEMAPHORE:
+                placeholder = queued_message.edit_text("●") if queued_message else message.answer("●")
+                # Заглушка в Telegram и открытие стрима — независимые сетевые запросы, шлём их параллельно
+                sent_message, stream = await asyncio.gather(
+                    placeholder,
+                    client.chat.completions.create(
+                        model=model_key,
+                        messages=messages,
+                        stream=True,
+                        extra_headers=OPENROUTER_HEADERS
+                    ),
+                    return_exceptions=True,
+                )
+                if isinstance(sent_message, BaseException):
+                    # Без заглушки отвечать некуда — закрываем уже открытый стрим, чтобы вернуть соединение в пул
+                    if not isinstance(stream, BaseException):
+                        await stream.close()
+                    raise sent_message
+                if isinstance(stream, BaseException):
+                    placeholder_message = sent_message
+                    raise stream
+                full_answer = await stream_reply(stream, sent_message)
+
+            # Пустой ответ в историю не пишем: его бы отправили модели в следующих ходах
+            if full_answer:
+                await history_store.add_messages(chat_history_id, [("user", content), ("assistant", full_answer)])
+                turn_saved = True
         
     except APIConnectionError as e:
         logger.error(f"Ошибка подключения: {str(e)}")
-        await message.answer("🔌 Проблемы с подключением к API")
+        await report_error("🔌 Проблемы с подключением к API")
     except RateLimitError as e:
         logger.error(f"Лимит запросов: {str(e)}")
-        await message.answer("⏳ Превышен лимит запросов, попробуйте позже")
+        await report_error("⏳ Превышен лимит запросов, попробуйте позже")
     except APIError as e:
         logger.error(f"API ошибка: {str(e)}")
-        await message.answer("⚠️ Ошибка API, попробуйте еще раз")
+        await report_error("⚠️ Ошибка API, попробуйте еще раз")
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
-        await message.answer("⚠️ Произошла ошибка при обработке запроса")
+        await report_error("⚠️ Произошла ошибка при обработке запроса")
 
-@dp.callback_query(F.data.startswith("delete_"))
-async def delete_chat(callback: types.CallbackQuery):
-    if callback.data == "delete_all_chats":
-        return
+    if model_key is not None and not turn_saved:
+        # Ответ не получен — сохраняем хотя бы вопрос пользователя
+        try:
+            await history_store.add_message(chat_history_id, "user", content)
+        except Exception as e:
+            # Например, чат удалили, пока шёл стрим
+            logger.error(f"Ошибка при сохранении сообщения: {e}")
+
+async def forget_current_chat(state: FSMContext):
+    await state.update_data(current_chat=None, current_title=None, current_model=None)
+
+# "delete_all_chats" тоже начинается с "delete_" — исключаем его, иначе до своего обработчика он не дойдёт
+@dp.callback_query(F.data.startswith("delete_") & (F.data != "delete_all_chats"))
+async def delete_chat(callback: types.CallbackQuery, state: FSMContext):
     try:
         chat_id = int(callback.data.split("_")[1])
     except ValueError:
         await callback.answer("Некорректный идентификатор чата")
         return
-    db.delete_chat(chat_id)
+    history_key = await db.delete_chat(chat_id, callback.from_user.id)
+    if history_key is None:
+        await callback.answer("❌ Чат не найден")
+        return
+    await delete_chat_history(history_key)
+    data = await state.get_data()
+    if data.get('current_chat') == chat_id:
+        await forget_current_chat(state)
     await callback.message.edit_text("✅ Чат успешно удален")
     await callback.answer()
 
 @dp.callback_query(F.data == "delete_all_chats")
-async def delete_all_chats(callback: types.CallbackQuery):
+async def delete_all_chats(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.delete_all_chats(user_id)
+    history_keys = await db.delete_all_chats(user_id)
+    await delete_chat_history(*history_keys)
+    await forget_current_chat(state)
     await callback.message.edit_text("✅ Все чаты успешно удалены")
     await callback.answer()
 
@@ -514,7 +1027,7 @@ async def rename_chat_start(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(renaming_chat=chat_id)
     await callback.message.answer(
         "📝 Введите новое название для чата:",
-        reply_markup=types.ReplyKeyboardRemove()
+        reply_markup=REMOVE_KEYBOARD
     )
     await callback.answer()
 
@@ -524,22 +1037,31 @@ async def rename_chat_finish(message: types.Message, state: FSMContext):
     chat_id = data['renaming_chat']
     new_title = message.text[:30]
     
-    db.rename_chat(chat_id, new_title)
-    await state.clear()
+    renamed = await db.rename_chat(chat_id, message.from_user.id, new_title)
+    # Сохраняем активный чат: state.clear() сбросил бы и его
+    if data.get('current_chat') == chat_id:
+        await state.update_data(current_title=new_title)
+    if data.get('current_chat'):
+        await state.set_state(ChatStates.waiting_for_message)
+    else:
+        await state.clear()
+    if not renamed:
+        await message.answer("❌ Чат не найден", reply_markup=MAIN_MENU_MARKUP)
+        return
     await message.answer(
         f"✅ Название чата изменено на '{new_title}'",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_MARKUP
     )
 
 @dp.callback_query(F.data == "settings_back")
 async def settings_back(callback: types.CallbackQuery):
-    await callback.message.edit_text("📝 Главное меню:", reply_markup=main_menu_keyboard())
+    await callback.message.edit_text("📝 Главное меню:", reply_markup=MAIN_MENU_MARKUP)
     await callback.answer()
 
 @dp.callback_query(F.data == "settings_favorites")
 async def settings_favorites(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    keyboard = favorite_models_keyboard(user_id)
+    keyboard = await favorite_models_keyboard(user_id)
     await callback.message.edit_text("⭐ Выберите избранные модели (нажмите для переключения):", reply_markup=keyboard)
     await callback.answer()
 
@@ -547,18 +1069,57 @@ async def settings_favorites(callback: types.CallbackQuery):
 async def toggle_favorite(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     model_key = callback.data[len("toggle_fav_"):]
-    favorites = db.get_favorites(user_id)
+    favorites = await db.get_favorites(user_id)
     if model_key in favorites:
-        db.remove_favorite(user_id, model_key)
+        await db.remove_favorite(user_id, model_key)
+        favorites.discard(model_key)
     else:
-        db.add_favorite(user_id, model_key)
-    keyboard = favorite_models_keyboard(user_id)
+        await db.add_favorite(user_id, model_key)
+        favorites.add(model_key)
+    invalidate_user_keyboards(user_id)
+    keyboard = await favorite_models_keyboard(user_id, favorites)
     await callback.message.edit_text("⭐ Выберите избранные модели (нажмите для переключения):", reply_markup=keyboard)
     await callback.answer("Избранное переключено")
 
+# Цикл событий хранит на задачи только слабые ссылки — держим их здесь, чтобы их не собрал GC
+_background_tasks = set()
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 @dp.startup()
 async def on_startup():
-    asyncio.create_task(model_updater())
+    await db.connect()
+    # Свежий кэш с диска позволяет не ждать OpenRouter при старте
+    cache_age = load_cached_models()
+    if cache_age is None:
+        # Кэша нет — без списка моделей новый чат не создать, поэтому ждём первую загрузку
+        # При неудаче фоновое обновление сразу переходит к повторам с backoff
+        initial_delay = MODELS_REFRESH_INTERVAL if await update_models() else 0
+    elif cache_age < MODELS_CACHE_TTL:
+        initial_delay = max(0, MODELS_REFRESH_INTERVAL - cache_age)
+    else:
+        initial_delay = 0
+    start_background_task(model_updater(initial_delay))
+    start_background_task(db_optimizer())
+
+@dp.shutdown()
+async def on_shutdown():
+    if history_store is not db:
+        await history_store.close()
+    await http_client.aclose()
+    await db.close()
 
 if __name__ == "__main__":
-    asyncio.run(dp.start_polling(bot))
+    # Каждый апдейт обрабатывается отдельной задачей: долгий стрим одного пользователя
+    # не задерживает команды остальных
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(dp.start_polling(
+            bot,
+            handle_as_tasks=True,
+            allowed_updates=dp.resolve_used_update_types(),
+        ))